@@ -10,14 +10,24 @@ This is the main Flask application that:
 3. Serves system status and health information
 
 Usage:
-    python app.py
+    python app.py                        (development server)
+    gunicorn -c gunicorn.conf.py app:app (production)
     
 Server will start at: http://localhost:5000
 """
 
-from flask import Flask, jsonify, request
+from flask import Flask, jsonify, request, make_response, Response, stream_with_context
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
-from datetime import datetime
+from datetime import datetime, timezone
+from functools import wraps
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import orjson
+import redis
+import atexit
+import logging
+import time
 import os
 import sys
 
@@ -27,9 +37,19 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 # Import custom modules
 from firebase_config import (
     initialize_firebase,
+    start_cache_listeners,
+    stop_cache_listeners,
     get_device_data,
+    get_device_status,
+    get_reading_count,
+    get_device_statuses,
+    get_counters,
     get_alerts,
-    get_database_reference
+    clear_alerts_cache,
+    get_database_reference,
+    server_increment,
+    utc_timestamp,
+    timestamp_seconds
 )
 from mqtt_handler import (
     initialize as init_mqtt,
@@ -37,8 +57,37 @@ from mqtt_handler import (
     stop_mqtt_client
 )
 
+# ============== JSON PROVIDER ==============
+# Stored timestamps are already ISO-8601 strings (UTC, see utc_timestamp),
+# never datetime objects, so OPT_NAIVE_UTC would have nothing to act on
+ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+
+class OrjsonProvider(JSONProvider):
+    """
+    Flask JSON provider backed by orjson, used by jsonify() and
+    request.get_json().
+    """
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=ORJSON_OPTIONS).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        # Hand orjson's bytes straight to the response, skipping the
+        # bytes -> str -> bytes round trip of the default implementation
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, option=ORJSON_OPTIONS),
+            mimetype="application/json"
+        )
+
+
 # ============== FLASK APP SETUP ==============
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # Enable CORS for dashboard access
 CORS(app, resources={
@@ -53,78 +102,221 @@ CORS(app, resources={
 HOST = os.getenv("HOST", "0.0.0.0")
 PORT = int(os.getenv("PORT", 5000))
 DEBUG = os.getenv("DEBUG", "False").lower() == "true"
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+# Redis response cache (dashboard pollers share one upstream Firebase read)
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+CACHE_TTL = int(os.getenv("CACHE_TTL", 3))  # seconds
+
+# Upper bound for the ?limit= query parameter on list endpoints
+MAX_LIMIT = int(os.getenv("MAX_LIMIT", 500))
+
+
+# ============== RESPONSE CACHE ==============
+redis_client = redis.Redis.from_url(
+    REDIS_URL,
+    socket_timeout=0.25,
+    socket_connect_timeout=0.25
+)
+
+
+def cached(key, ttl=CACHE_TTL, vary_on_limit=False):
+    """
+    Cache a route's JSON body in Redis for a few seconds.
+    
+    Each variant is its own key "api:<key>:<variant>" with its own TTL.
+    The variant is the parsed ?limit= value for routes that take one,
+    not the raw query string, so unrelated or cache-busting query
+    parameters can't create new entries. If Redis is unreachable the
+    view is simply called uncached. Streaming responses are never
+    cached, so cached routes should return regular responses.
+    
+    Args:
+        key: Cache name for the route (e.g., "status", "alerts")
+        ttl: Time to live in seconds
+        vary_on_limit: Cache each ?limit= value separately
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            variant = str(get_limit_arg()) if vary_on_limit else "-"
+            cache_key = f"api:{key}:{variant}"
+            
+            try:
+                body = redis_client.get(cache_key)
+                if body is not None:
+                    return Response(body, mimetype="application/json")
+            except redis.RedisError:
+                pass
+            
+            response = make_response(view(*args, **kwargs))
+            
+            # Only cache successful responses. Streamed bodies are passed
+            # through uncached; reading them here would buffer the stream.
+            if response.status_code == 200 and not response.is_streamed:
+                try:
+                    redis_client.setex(cache_key, ttl, response.get_data())
+                except redis.RedisError:
+                    pass
+            
+            return response
+        return wrapper
+    return decorator
+
+
+def invalidate_cache(*keys):
+    """
+    Drop all cached variants of the given route keys.
+    
+    Variants are bounded (one per limit value), so scanning for them
+    is cheap; this only runs on writes such as acknowledging an alert.
+    """
+    try:
+        for key in keys:
+            stale = list(redis_client.scan_iter(match=f"api:{key}:*", count=100))
+            if stale:
+                redis_client.unlink(*stale)
+    except redis.RedisError:
+        pass
+
+
+# ============== PARALLEL FIREBASE READS ==============
+# Independent Firebase reads are submitted together so a request waits
+# for the slowest read instead of the sum of all of them.
+executor = ThreadPoolExecutor(max_workers=4)
+
+
+# ============== REQUEST HELPERS ==============
+def get_limit_arg(default=50):
+    """
+    Read the ?limit= query parameter, clamped to 1..MAX_LIMIT.
+    """
+    limit = request.args.get('limit', default, type=int)
+    return max(1, min(limit, MAX_LIMIT))
+
+
+_now_iso_second = None
+_now_iso_value = None
+
+
+def now_iso():
+    """
+    Current UTC time as an ISO-8601 string with second precision.
+    
+    The string is rebuilt at most once per second and shared by all
+    requests in between, instead of formatting a datetime per request.
+    """
+    global _now_iso_second, _now_iso_value
+    
+    second = int(time.time())
+    if second != _now_iso_second:
+        _now_iso_value = datetime.fromtimestamp(second, timezone.utc).isoformat()
+        _now_iso_second = second
+    return _now_iso_value
+
+
+# ============== STREAMING JSON ==============
+STREAM_CHUNK_SIZE = 100  # Records serialized per yielded chunk
+
+
+def stream_json_list(fields, key, items):
+    """
+    Stream a JSON object whose last member is a list of records.
+    
+    Records are serialized with orjson in chunks as the response is
+    sent, instead of building the whole body in memory first.
+    
+    Args:
+        fields: Leading members of the object (e.g., {"count": 10})
+        key: Name of the list member (e.g., "alerts")
+        items: List of JSON-serializable records
+    
+    Returns:
+        Response: Streaming application/json response
+    """
+    def generate():
+        # '{"count":10' + ',"alerts":['
+        yield orjson.dumps(fields)[:-1] + b"," + orjson.dumps(key) + b":["
+        for start in range(0, len(items), STREAM_CHUNK_SIZE):
+            chunk = b",".join(
+                orjson.dumps(item)
+                for item in items[start:start + STREAM_CHUNK_SIZE]
+            )
+            yield (b"," + chunk) if start else chunk
+        yield b"]}"
+    
+    return Response(stream_with_context(generate()), mimetype="application/json")
 
 
 # ============== ROUTES ==============
 
+# Static API information, serialized once at import
+HOME_BODY = orjson.dumps({
+    "name": "IoT Anomaly Detection API",
+    "version": "1.0.0",
+    "status": "running",
+    "endpoints": {
+        "GET /": "API information",
+        "GET /api/status": "System status",
+        "GET /api/devices": "List all devices",
+        "GET /api/devices/<id>": "Get device details",
+        "GET /api/devices/<id>/readings": "Get device readings",
+        "GET /api/alerts": "Get all alerts",
+        "POST /api/alerts/<id>/acknowledge": "Acknowledge alert"
+    }
+})
+
+
 @app.route("/")
 def home():
     """
     Home route - API information.
     """
-    return jsonify({
-        "name": "IoT Anomaly Detection API",
-        "version": "1.0.0",
-        "status": "running",
-        "timestamp": datetime.now().isoformat(),
-        "endpoints": {
-            "GET /": "API information",
-            "GET /api/status": "System status",
-            "GET /api/devices": "List all devices",
-            "GET /api/devices/<id>": "Get device details",
-            "GET /api/devices/<id>/readings": "Get device readings",
-            "GET /api/alerts": "Get all alerts",
-            "POST /api/alerts/<id>/acknowledge": "Acknowledge alert"
-        }
-    })
+    return Response(HOME_BODY, mimetype="application/json")
 
 
 @app.route("/api/status")
+@cached("status")
 def get_status():
     """
     Get overall system status.
     """
     mqtt_status = get_mqtt_status()
     
-    # Get device count
-    devices_ref = get_database_reference("/devices")
-    devices = devices_ref.get() if devices_ref else {}
-    device_count = len(devices) if devices else 0
-    
-    # Get alert count
-    alerts = get_alerts(limit=100)
-    unacknowledged_alerts = sum(1 for a in alerts if not a.get('acknowledged', False))
+    # Device and alert counts are maintained under /counters
+    counters = get_counters()
+    device_count = counters.get('devices_total', 0)
     
     return jsonify({
         "status": "online",
-        "timestamp": datetime.now().isoformat(),
+        "timestamp": now_iso(),
         "mqtt": mqtt_status,
         "devices": {
             "total": device_count,
-            "online": device_count  # TODO: Check actual online status
+            "online": device_count,  # TODO: Check actual online status
+            "threat": counters.get('devices_threat', 0)
         },
         "alerts": {
-            "total": len(alerts),
-            "unacknowledged": unacknowledged_alerts
+            "total": counters.get('alerts_total', 0),
+            "unacknowledged": counters.get('unacked_alerts', 0)
         }
     })
 
 
 @app.route("/api/devices")
+@cached("devices")
 def list_devices():
     """
     List all registered devices.
     """
     try:
-        devices_ref = get_database_reference("/devices")
-        devices = devices_ref.get() if devices_ref else {}
+        devices = get_device_statuses()
         
         if not devices:
             return jsonify([])
         
         device_list = []
-        for device_id, device_data in devices.items():
-            status = device_data.get('status', {})
+        for device_id, status in devices.items():
             device_list.append({
                 "id": device_id,
                 "state": status.get('state', 'unknown'),
@@ -146,16 +338,20 @@ def get_device(device_id):
     Get specific device details.
     """
     try:
-        device_ref = get_database_reference(f"/devices/{device_id}")
-        device = device_ref.get() if device_ref else None
+        # Read the status and reading count concurrently instead of
+        # downloading the whole device node with all its readings
+        status_future = executor.submit(get_device_status, device_id)
+        count_future = executor.submit(get_reading_count, device_id)
+        status = status_future.result()
+        reading_count = count_future.result()
         
-        if not device:
+        if status is None and not reading_count:
             return jsonify({"error": "Device not found"}), 404
         
         return jsonify({
             "id": device_id,
-            "status": device.get('status', {}),
-            "reading_count": len(device.get('readings', {}))
+            "status": status or {},
+            "reading_count": reading_count
         })
         
     except Exception as e:
@@ -166,97 +362,129 @@ def get_device(device_id):
 def get_device_readings(device_id):
     """
     Get recent readings for a specific device.
+    
+    Query parameters:
+        limit: Number of readings (default 50, max MAX_LIMIT)
+        fields: Comma-separated fields to return (e.g., temperature,humidity)
     """
     try:
-        limit = request.args.get('limit', 50, type=int)
-        readings = get_device_data(device_id, limit=limit)
+        limit = get_limit_arg()
+        fields = [f for f in request.args.get('fields', '').split(',') if f]
+        readings = get_device_data(device_id, limit=limit, fields=fields)
         
-        return jsonify({
-            "device_id": device_id,
-            "count": len(readings),
-            "readings": readings
-        })
+        return stream_json_list(
+            {"device_id": device_id, "count": len(readings)},
+            "readings",
+            readings
+        )
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
 @app.route("/api/alerts")
+@cached("alerts", vary_on_limit=True)
 def list_alerts():
     """
     Get all alerts.
     """
     try:
-        limit = request.args.get('limit', 50, type=int)
-        alerts = get_alerts(limit=limit)
-        
-        # Sort by timestamp (newest first)
-        alerts.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
+        limit = get_limit_arg()
+        alerts = get_alerts(limit=limit)  # Newest first
         
-        return jsonify({
-            "count": len(alerts),
-            "alerts": alerts
-        })
+        # Not streamed: the body is stored in the response cache anyway
+        return jsonify({"count": len(alerts), "alerts": alerts})
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
+class _AlertNotFound(Exception):
+    """
+    Raised inside the acknowledge transaction to abort it.
+    """
+
+
 @app.route("/api/alerts/<alert_id>/acknowledge", methods=["POST"])
 def acknowledge_alert(alert_id):
     """
     Acknowledge an alert.
     """
     try:
-        alert_ref = get_database_reference(f"/alerts/{alert_id}")
-        if alert_ref:
-            alert_ref.update({
-                "acknowledged": True,
-                "acknowledged_at": datetime.now().isoformat()
-            })
-            return jsonify({"success": True, "message": "Alert acknowledged"})
-        else:
+        flag_ref = get_database_reference(f"/alerts/{alert_id}/acknowledged")
+        if not flag_ref:
+            return jsonify({"error": "Firebase not initialized"}), 503
+        
+        # Flip the flag in a transaction on just that flag, so concurrent
+        # acknowledgements (e.g. a double-click) decrement the counter once
+        result = {"changed": False}
+        
+        def mark_acknowledged(acknowledged):
+            # Alerts are always written with an "acknowledged" flag, so a
+            # missing flag means the alert does not exist. Raising aborts
+            # the transaction (returning None would make the SDK fail
+            # with "Value must not be none.")
+            if acknowledged is None:
+                raise _AlertNotFound(alert_id)
+            result["changed"] = acknowledged is False
+            return True
+        
+        try:
+            flag_ref.transaction(mark_acknowledged)
+        except _AlertNotFound:
             return jsonify({"error": "Alert not found"}), 404
+        
+        if result["changed"]:
+            # Only the request that flipped the flag gets here
+            get_database_reference("/").update({
+                f"alerts/{alert_id}/acknowledged_at": utc_timestamp(),
+                "counters/unacked_alerts": server_increment(-1)
+            })
+        
+        clear_alerts_cache()
+        invalidate_cache("alerts", "status", "dashboard")
+        return jsonify({"success": True, "message": "Alert acknowledged"})
             
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
 @app.route("/api/dashboard/summary")
+@cached("dashboard")
 def dashboard_summary():
     """
     Get dashboard summary data.
     """
     try:
-        # Get devices
-        devices_ref = get_database_reference("/devices")
-        devices = devices_ref.get() if devices_ref else {}
+        # Fetch devices and recent alerts concurrently
+        devices_future = executor.submit(get_device_statuses)
+        alerts_future = executor.submit(get_alerts, limit=5)
+        devices = devices_future.result()
         
         # Calculate stats
-        total_devices = len(devices) if devices else 0
-        normal_devices = 0
-        threat_devices = 0
-        latest_reading = None
+        total_devices = len(devices)
+        states = Counter(status.get('state') for status in devices.values())
+        threat_devices = states["threat"]
+        normal_devices = total_devices - threat_devices
         
-        for device_id, device_data in (devices or {}).items():
-            status = device_data.get('status', {})
-            if status.get('state') == 'threat':
-                threat_devices += 1
-            else:
-                normal_devices += 1
-            
-            # Get latest reading
-            if not latest_reading or status.get('last_seen', '') > latest_reading.get('timestamp', ''):
-                latest_reading = {
-                    "device_id": device_id,
-                    "temperature": status.get('temperature'),
-                    "humidity": status.get('humidity'),
-                    "gas_level": status.get('gas_level'),
-                    "timestamp": status.get('last_seen')
-                }
+        # Get latest reading (compared as instants: older records hold
+        # naive local times, newer ones UTC, so the strings don't sort)
+        latest_reading = None
+        if devices:
+            device_id, status = max(
+                devices.items(),
+                key=lambda item: timestamp_seconds(item[1].get('last_seen'))
+            )
+            latest_reading = {
+                "device_id": device_id,
+                "temperature": status.get('temperature'),
+                "humidity": status.get('humidity'),
+                "gas_level": status.get('gas_level'),
+                "timestamp": status.get('last_seen')
+            }
         
         # Get recent alerts
-        alerts = get_alerts(limit=10)
+        alerts = alerts_future.result()
         
         return jsonify({
             "devices": {
@@ -265,8 +493,8 @@ def dashboard_summary():
                 "threat": threat_devices
             },
             "latest_reading": latest_reading,
-            "recent_alerts": alerts[:5],  # Last 5 alerts
-            "timestamp": datetime.now().isoformat()
+            "recent_alerts": alerts,  # Last 5 alerts
+            "timestamp": now_iso()
         })
         
     except Exception as e:
@@ -284,11 +512,18 @@ def server_error(e):
     return jsonify({"error": "Internal server error"}), 500
 
 
-# ============== MAIN ==============
-def main():
+# ============== STARTUP ==============
+def init_components():
     """
-    Main entry point - initialize components and start server.
+    Initialize Firebase and the MQTT handler.
+    
+    Called once per server process: by main() for the development
+    server, and by the post_worker_init hook in gunicorn.conf.py.
+    The matching cleanup is stop_cache_listeners().
     """
+    # MQTT message logging (DEBUG shows every message and payload)
+    logging.basicConfig(level=LOG_LEVEL, format="%(message)s")
+    
     print("\n" + "="*60)
     print("   🛡️  IoT Anomaly Detection Backend Server")
     print("="*60 + "\n")
@@ -297,23 +532,36 @@ def main():
     print("[INIT] Initializing Firebase...")
     if not initialize_firebase():
         print("[WARNING] Firebase initialization failed, some features may not work")
+    elif not start_cache_listeners():
+        print("[WARNING] Realtime cache disabled, API will read from Firebase")
     
     # Initialize MQTT handler
     print("[INIT] Starting MQTT handler...")
     if not init_mqtt():
         print("[WARNING] MQTT initialization failed, data ingestion disabled")
     
+    # The server process owns shutdown, so stop MQTT when it exits
+    atexit.register(stop_mqtt_client)
+
+
+# ============== MAIN ==============
+def main():
+    """
+    Development entry point - initialize components and start the
+    Flask development server. Use gunicorn (see gunicorn.conf.py)
+    in production.
+    """
+    init_components()
+    
     # Start Flask server
-    print(f"\n[SERVER] Starting Flask server on http://{HOST}:{PORT}")
+    print(f"\n[SERVER] Starting Flask development server on http://{HOST}:{PORT}")
     print("[SERVER] Press Ctrl+C to stop\n")
     print("="*60 + "\n")
     
-    try:
-        app.run(host=HOST, port=PORT, debug=DEBUG)
-    except KeyboardInterrupt:
-        print("\n[SERVER] Shutting down...")
-        stop_mqtt_client()
-        print("[SERVER] Goodbye!")
+    app.run(host=HOST, port=PORT, debug=DEBUG)
+    
+    print("\n[SERVER] Shutting down...")
+    stop_cache_listeners()
 
 
 if __name__ == "__main__":
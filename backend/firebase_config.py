@@ -12,6 +12,13 @@ IMPORTANT: Never expose the service account JSON in frontend code!
 
 import firebase_admin
 from firebase_admin import credentials, db
+from requests.adapters import HTTPAdapter
+from cachetools import TTLCache, cached
+from collections import Counter
+from datetime import datetime, timezone
+import threading
+import random
+import time
 import os
 import json
 
@@ -25,8 +32,30 @@ SERVICE_ACCOUNT_PATH = os.path.join(
 # Firebase Realtime Database URL
 DATABASE_URL = "https://iotthreatmonitor-default-rtdb.firebaseio.com"
 
+# HTTP connection pool for database requests. Sized for concurrent API
+# requests plus the MQTT writer, so TLS connections are reused instead
+# of being discarded when the default pool (10) is full.
+HTTP_POOL_SIZE = int(os.getenv("FIREBASE_HTTP_POOL_SIZE", 50))
+
+# Seconds that get_alerts() results are shared between callers in
+# this process
+ALERTS_CACHE_TTL = float(os.getenv("ALERTS_CACHE_TTL", 1))
+
+# Paths whose references are created once at initialization
+COMMON_PATHS = ["/devices", "/device_status", "/alerts", "/counters"]
+
+# Denormalized counters stored under /counters
+COUNTER_NAMES = ["alerts_total", "unacked_alerts", "devices_total", "devices_threat"]
+
+# Small nodes mirrored in memory by realtime listeners (see
+# start_cache_listeners). Never add /devices or /alerts here: the
+# listener would download and hold the whole subtree.
+CACHED_PATHS = ["/device_status", "/counters"]
+
 # ============== FIREBASE INITIALIZATION ==============
 _firebase_app = None
+_root_ref = None
+_common_refs = {}
 
 def initialize_firebase():
     """
@@ -35,7 +64,7 @@ def initialize_firebase():
     Returns:
         bool: True if initialization successful, False otherwise
     """
-    global _firebase_app
+    global _firebase_app, _root_ref
     
     # Check if already initialized
     if _firebase_app is not None:
@@ -58,6 +87,14 @@ def initialize_firebase():
             'databaseURL': DATABASE_URL
         })
         
+        # Build the root and frequently used references once
+        _root_ref = db.reference("/")
+        _common_refs["/"] = _root_ref
+        for path in COMMON_PATHS:
+            _common_refs[path] = _root_ref.child(path.strip("/"))
+        
+        configure_connection_pool(_root_ref)
+        
         print("[FIREBASE] Initialized successfully!")
         print(f"[FIREBASE] Project: {cred.project_id}")
         return True
@@ -67,28 +104,377 @@ def initialize_firebase():
         return False
 
 
+def configure_connection_pool(root_ref):
+    """
+    Enlarge the keep-alive connection pool of the database HTTP session.
+    
+    All references share one session per database URL; this mounts a
+    larger HTTPAdapter on it, keeping the SDK's retry settings.
+    
+    Args:
+        root_ref: Root database reference
+    """
+    try:
+        session = root_ref._client.session
+        retries = session.get_adapter(DATABASE_URL).max_retries
+        session.mount("https://", HTTPAdapter(
+            pool_connections=HTTP_POOL_SIZE,
+            pool_maxsize=HTTP_POOL_SIZE,
+            max_retries=retries
+        ))
+        print(f"[FIREBASE] HTTP connection pool size: {HTTP_POOL_SIZE}")
+    except Exception as e:
+        # Relies on SDK internals; fall back to the default pool
+        print(f"[WARNING] Could not configure HTTP connection pool: {e}")
+
+
 def get_database_reference(path="/"):
     """
     Get a reference to a specific path in the Realtime Database.
     
+    References for COMMON_PATHS are reused; other paths are derived
+    from the cached root reference.
+    
     Args:
         path: Database path (e.g., "/devices", "/alerts")
     
     Returns:
         Reference object or None if Firebase not initialized
     """
-    if _firebase_app is None:
+    if _root_ref is None:
         if not initialize_firebase():
             return None
     
-    return db.reference(path)
+    ref = _common_refs.get(path)
+    if ref is None:
+        ref = _root_ref.child(path.strip("/"))
+    return ref
+
+
+def server_increment(delta):
+    """
+    Build a server-side increment value for set()/update().
+    
+    The database applies the increment atomically, so counters can be
+    updated as part of a normal write without a read-modify-write.
+    
+    Args:
+        delta: Amount to add (negative to decrement)
+    """
+    return {".sv": {"increment": delta}}
+
+
+# ============== TIMESTAMPS ==============
+def utc_timestamp():
+    """
+    Current UTC time as ISO-8601 with millisecond precision,
+    e.g. "2024-01-01T12:00:00.123Z". Used for every stored timestamp.
+    """
+    return datetime.now(timezone.utc).isoformat(timespec="milliseconds")[:-6] + "Z"
+
+
+def timestamp_seconds(value):
+    """
+    Convert a stored timestamp to seconds since the epoch, for ordering.
+    
+    Records written before timestamps were UTC hold naive local times
+    (no "Z"); those are read as local time so they order correctly
+    against the UTC ones.
+    
+    Args:
+        value: ISO-8601 string, or None
+    
+    Returns:
+        float: Epoch seconds (0 for a missing or unparseable value)
+    """
+    if not value:
+        return 0.0
+    try:
+        # astimezone() treats naive values as local time
+        return datetime.fromisoformat(value).astimezone(timezone.utc).timestamp()
+    except (TypeError, ValueError):
+        return 0.0
+
+
+# ============== REALTIME CACHE ==============
+# Snapshots of CACHED_PATHS kept up to date by listener events. Updates
+# copy the dicts along the changed path, so a snapshot handed to a
+# reader is never mutated afterwards.
+_cache_lock = threading.RLock()
+_cache_snapshots = {}
+_cache_listeners = []
+_NOT_CACHED = object()
+
+
+def _put_path(node, keys, value):
+    """
+    Return a copy of node with value stored at the given key path.
+    A None value deletes the key, as in the database.
+    """
+    if not keys:
+        return value
+    
+    node = dict(node) if isinstance(node, dict) else {}
+    child = _put_path(node.get(keys[0]), keys[1:], value)
+    if child is None:
+        node.pop(keys[0], None)
+    else:
+        node[keys[0]] = child
+    return node or None
+
+
+def _make_cache_listener(path):
+    """
+    Build a listener callback that applies events to the snapshot of path.
+    """
+    def on_event(event):
+        keys = [k for k in event.path.split("/") if k]
+        with _cache_lock:
+            node = _cache_snapshots.get(path)
+            if event.event_type == "patch":
+                for child_path, value in event.data.items():
+                    child_keys = [k for k in child_path.split("/") if k]
+                    node = _put_path(node, keys + child_keys, value)
+            else:
+                node = _put_path(node, keys, event.data)
+            _cache_snapshots[path] = node
+    return on_event
+
+
+def start_cache_listeners():
+    """
+    Subscribe to CACHED_PATHS and mirror them in memory.
+    
+    After the initial event for a path, readers such as
+    get_device_statuses() and get_counters() are served from memory
+    instead of issuing a database read.
+    
+    Returns:
+        bool: True if the listeners were started
+    """
+    if _cache_listeners:
+        return True
+    
+    try:
+        for path in CACHED_PATHS:
+            ref = get_database_reference(path)
+            if ref is None:
+                return False
+            _cache_listeners.append(ref.listen(_make_cache_listener(path)))
+            print(f"[FIREBASE] Listening for changes on {path}")
+        return True
+    except Exception as e:
+        print(f"[ERROR] Failed to start cache listeners: {e}")
+        stop_cache_listeners()
+        return False
+
+
+def stop_cache_listeners():
+    """
+    Close the realtime listeners. Their threads are not daemon threads,
+    so this must be called before the process can exit.
+    """
+    with _cache_lock:
+        while _cache_listeners:
+            _cache_listeners.pop().close()
+        _cache_snapshots.clear()
+
+
+def get_cached_node(path):
+    """
+    Get the in-memory snapshot of a cached path.
+    
+    Returns:
+        The node value (None if empty), or _NOT_CACHED if the path is
+        not being listened to or its initial event has not arrived yet
+    """
+    with _cache_lock:
+        return _cache_snapshots.get(path, _NOT_CACHED)
+
+
+# ============== PUSH IDS ==============
+# Client-side equivalent of the keys generated by push(), so new
+# readings and alerts can be written as part of a multi-path update.
+# 8 characters of millisecond timestamp followed by 12 random ones;
+# keys generated in the same millisecond increment the random part so
+# they still sort in creation order.
+PUSH_CHARS = "-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz"
+_push_lock = threading.Lock()
+_last_push_time = 0
+_last_push_random = [0] * 12
+
+
+def generate_push_id():
+    """
+    Generate a chronologically ordered, unique push key.
+    
+    Returns:
+        str: 20-character key
+    """
+    global _last_push_time
+    
+    with _push_lock:
+        now = int(time.time() * 1000)
+        duplicate_time = now == _last_push_time
+        _last_push_time = now
+        
+        time_chars = []
+        for _ in range(8):
+            time_chars.append(PUSH_CHARS[now % 64])
+            now //= 64
+        
+        if not duplicate_time:
+            for i in range(12):
+                _last_push_random[i] = random.randrange(64)
+        else:
+            # Increment the random part, carrying over on overflow
+            i = 11
+            while i >= 0 and _last_push_random[i] == 63:
+                _last_push_random[i] = 0
+                i -= 1
+            if i >= 0:
+                _last_push_random[i] += 1
+        
+        return "".join(reversed(time_chars)) + "".join(
+            PUSH_CHARS[i] for i in _last_push_random
+        )
+
+
+# ============== DEVICE COUNTERS ==============
+# Last state written for each device by this process, used to detect
+# new devices and normal <-> threat transitions for /counters.
+_device_states = {}
+_device_states_lock = threading.Lock()
+_UNKNOWN_STATE = object()
+
+
+def count_device_transition(device_id, new_state, increments):
+    """
+    Add the /counters deltas for a device moving to new_state.
+    
+    The previous state is looked up in the database only the first time
+    a device is seen by this process.
+    
+    Args:
+        device_id: Unique device identifier
+        new_state: State being written ("normal" or "threat")
+        increments: Counter of path -> delta to add to
+    """
+    with _device_states_lock:
+        previous = _device_states.get(device_id, _UNKNOWN_STATE)
+        if previous is _UNKNOWN_STATE:
+            ref = get_database_reference(f"/device_status/{device_id}/state")
+            previous = ref.get() if ref else None
+        _device_states[device_id] = new_state
+    
+    if previous is None:
+        increments["counters/devices_total"] += 1
+    
+    was_threat = previous == "threat"
+    is_threat = new_state == "threat"
+    if was_threat != is_threat:
+        increments["counters/devices_threat"] += 1 if is_threat else -1
+
+
+def forget_device_states(device_ids):
+    """
+    Drop cached states so they are re-read from the database.
+    
+    Used when a write that counted transitions for these devices
+    failed: the database still holds the old state, and the next write
+    must count against that, not against the state that was never saved.
+    
+    Args:
+        device_ids: Iterable of device IDs
+    """
+    with _device_states_lock:
+        for device_id in device_ids:
+            _device_states.pop(device_id, None)
 
 
 # ============== DATABASE OPERATIONS ==============
+def write_batch(items):
+    """
+    Write a batch of readings, status updates and alerts in a single
+    multi-path update (one round trip, applied atomically).
+    
+    Each item is a (kind, device_id, data) tuple where kind is:
+        "reading": new entry under /devices/<id>/readings
+        "status":  fields merged into the device status
+        "alert":   new entry under /alerts; also marks the device as a threat
+    
+    Status fields are written to both /devices/<id>/status and the
+    denormalized /device_status/<id>. Reading counts and the /counters
+    node are adjusted with server-side increments, summed per path.
+    
+    Args:
+        items: List of (kind, device_id, data) tuples
+    
+    Returns:
+        list: Generated key for each item (None for status items), or
+        None on error
+    """
+    updates = {}
+    increments = Counter()
+    keys = []
+    counted_devices = set()
+    
+    def set_status(device_id, status):
+        for field, value in status.items():
+            updates[f"devices/{device_id}/status/{field}"] = value
+            updates[f"device_status/{device_id}/{field}"] = value
+        if "state" in status:
+            counted_devices.add(device_id)
+            count_device_transition(device_id, status["state"], increments)
+    
+    try:
+        for kind, device_id, data in items:
+            if kind == "reading":
+                key = generate_push_id()
+                updates[f"devices/{device_id}/readings/{key}"] = data
+                increments[f"devices/{device_id}/reading_count"] += 1
+                keys.append(key)
+            
+            elif kind == "status":
+                set_status(device_id, data)
+                keys.append(None)
+            
+            elif kind == "alert":
+                key = generate_push_id()
+                # Numeric timestamp for server-side ordering (see get_alerts)
+                updates[f"alerts/{key}"] = dict(data, ts_ms=int(time.time() * 1000))
+                increments["counters/alerts_total"] += 1
+                increments["counters/unacked_alerts"] += 1
+                set_status(device_id, {
+                    "state": "threat",
+                    "last_alert": data.get("timestamp"),
+                    "message": data.get("message")
+                })
+                keys.append(key)
+        
+        for path, delta in increments.items():
+            if delta:
+                updates[path] = server_increment(delta)
+        
+        ref = get_database_reference("/")
+        if ref and updates:
+            ref.update(updates)
+            return keys
+    except Exception as e:
+        print(f"[ERROR] Failed to write batch of {len(items)} items: {e}")
+    
+    # Nothing was written, so the transitions counted above didn't happen
+    forget_device_states(counted_devices)
+    return None
+
+
 def save_device_data(device_id, data):
     """
     Save device sensor data to Firebase.
     
+    Also increments /devices/<id>/reading_count so the reading count
+    can be served without downloading the readings.
+    
     Args:
         device_id: Unique device identifier
         data: Dictionary containing sensor readings
@@ -96,19 +482,13 @@ def save_device_data(device_id, data):
     Returns:
         str: Key of the saved record, or None on error
     """
-    try:
-        ref = get_database_reference(f"/devices/{device_id}/readings")
-        if ref:
-            new_ref = ref.push(data)
-            return new_ref.key
-    except Exception as e:
-        print(f"[ERROR] Failed to save device data: {e}")
-    return None
+    keys = write_batch([("reading", device_id, data)])
+    return keys[0] if keys else None
 
 
 def save_alert(device_id, alert_data):
     """
-    Save an anomaly alert to Firebase.
+    Save an anomaly alert to Firebase and mark the device as a threat.
     
     Args:
         device_id: Device that triggered the alert
@@ -117,51 +497,248 @@ def save_alert(device_id, alert_data):
     Returns:
         str: Key of the saved alert, or None on error
     """
-    try:
-        ref = get_database_reference(f"/alerts")
-        if ref:
-            new_ref = ref.push(alert_data)
-            
-            # Also update device status
-            status_ref = get_database_reference(f"/devices/{device_id}/status")
-            if status_ref:
-                status_ref.set({
-                    "state": "threat",
-                    "last_alert": alert_data.get("timestamp"),
-                    "message": alert_data.get("message")
-                })
-            
-            return new_ref.key
-    except Exception as e:
-        print(f"[ERROR] Failed to save alert: {e}")
-    return None
+    keys = write_batch([("alert", device_id, alert_data)])
+    return keys[0] if keys else None
 
 
 def update_device_status(device_id, status):
     """
     Update device status in Firebase.
     
+    The status is written to /devices/<id>/status and denormalized to
+    /device_status/<id>, so API summaries can read statuses without
+    downloading every device's readings. The device counters under
+    /counters are adjusted in the same update.
+    
     Args:
         device_id: Unique device identifier
         status: Status dictionary (state, last_seen, etc.)
     """
+    return write_batch([("status", device_id, status)]) is not None
+
+
+def get_device_statuses():
+    """
+    Get the status of every device from the denormalized /device_status node.
+    
+    Served from the realtime cache when it is available. The returned
+    dict must not be modified.
+    
+    Returns:
+        dict: Status dictionaries keyed by device ID
+    """
+    cached = get_cached_node("/device_status")
+    if cached is not _NOT_CACHED:
+        return cached or {}
+    
     try:
-        ref = get_database_reference(f"/devices/{device_id}/status")
+        ref = get_database_reference("/device_status")
         if ref:
-            ref.update(status)
+            data = ref.get()
+            if data:
+                return data
+    except Exception as e:
+        print(f"[ERROR] Failed to get device statuses: {e}")
+    return {}
+
+
+def rebuild_counters():
+    """
+    Recompute all counters from full scans of /alerts and /device_status.
+    
+    Only needed once for databases that have data written before
+    the counters existed.
+    
+    Returns:
+        dict: The rebuilt counters
+    """
+    ref = get_database_reference("/alerts")
+    alerts = (ref.get() if ref else None) or {}
+    
+    ref = get_database_reference("/device_status")
+    statuses = (ref.get() if ref else None) or {}
+    
+    counters = {
+        "alerts_total": len(alerts),
+        "unacked_alerts": sum(
+            1 for a in alerts.values() if not a.get('acknowledged', False)
+        ),
+        "devices_total": len(statuses),
+        "devices_threat": sum(
+            1 for st in statuses.values() if st.get('state') == 'threat'
+        )
+    }
+    
+    counters_ref = get_database_reference("/counters")
+    if counters_ref:
+        counters_ref.update(counters)
+    return counters
+
+
+def backfill_device_status():
+    """
+    Copy /devices/<id>/status into /device_status for devices that are
+    missing there, once.
+    
+    /device_status only gets entries when a device reports, so devices
+    written before it existed would be missing from list_devices,
+    the dashboard and devices_total until their next message. Device
+    IDs are read with shallow reads, so readings are not downloaded.
+    Completion is recorded under /migrations/device_status.
+    
+    Returns:
+        int: Number of devices copied (0 if already done or on error)
+    """
+    try:
+        marker_ref = get_database_reference("/migrations/device_status")
+        if not marker_ref or marker_ref.get() is not None:
+            return 0
+        
+        device_ids = get_database_reference("/devices").get(shallow=True) or {}
+        existing = get_database_reference("/device_status").get(shallow=True) or {}
+        
+        updates = {}
+        for device_id in device_ids:
+            if device_id in existing:
+                continue
+            status = get_database_reference(f"/devices/{device_id}/status").get()
+            if status:
+                updates[f"device_status/{device_id}"] = status
+        
+        if updates:
+            get_database_reference("/").update(updates)
+            print(f"[FIREBASE] Backfilled /device_status for {len(updates)} devices")
+        marker_ref.set({"backfilled_at": int(time.time() * 1000)})
+        return len(updates)
+    except Exception as e:
+        print(f"[ERROR] Failed to backfill device statuses: {e}")
+        return 0
+
+
+def prepare_denormalized_data():
+    """
+    One-time migrations for databases written before the denormalized
+    nodes existed. Run at startup, before any writes begin.
+    
+    Returns:
+        bool: True if the counters are ready
+    """
+    # Counters are computed from /device_status, so backfill it first
+    # (and recount if devices were added after an earlier rebuild)
+    added = backfill_device_status()
+    return prepare_counters(force=added > 0)
+
+
+def prepare_counters(force=False):
+    """
+    Rebuild /counters once for a database that has no (or untrusted)
+    counters, before any writes start incrementing them.
+    
+    Databases with alerts from before the counters existed would
+    otherwise get counters created by the first increments (e.g. 5 old
+    alerts + 1 new one giving alerts_total == 1). Completion is
+    recorded under /migrations/counters, so this runs only once.
+    
+    Args:
+        force: Rebuild even if it was already done
+    
+    Returns:
+        bool: True if the counters are ready
+    """
+    try:
+        marker_ref = get_database_reference("/migrations/counters")
+        if not marker_ref:
+            return False
+        if not force and marker_ref.get() is not None:
             return True
+        
+        print("[FIREBASE] Rebuilding counters from existing data...")
+        counters = rebuild_counters()
+        marker_ref.set({"rebuilt_at": int(time.time() * 1000)})
+        print(f"[FIREBASE] Counters rebuilt: {counters}")
+        return True
+    except Exception as e:
+        print(f"[ERROR] Failed to prepare counters: {e}")
+        return False
+
+
+def get_counters():
+    """
+    Get the denormalized counters stored under /counters.
+    
+    Served from the realtime cache when it is available. The counters
+    are (re)built at startup by prepare_counters(), never on this read
+    path, so a missing counter is simply absent from the result.
+    
+    Returns:
+        dict: Counter values (see COUNTER_NAMES)
+    """
+    cached = get_cached_node("/counters")
+    if cached is not _NOT_CACHED:
+        return cached or {}
+    
+    try:
+        ref = get_database_reference("/counters")
+        if ref:
+            return ref.get() or {}
+    except Exception as e:
+        print(f"[ERROR] Failed to get counters: {e}")
+    return {}
+
+
+def get_device_status(device_id):
+    """
+    Get the status of a single device.
+    
+    Args:
+        device_id: Unique device identifier
+    
+    Returns:
+        dict: Status dictionary, or None if the device is unknown
+    """
+    try:
+        ref = get_database_reference(f"/devices/{device_id}/status")
+        if ref:
+            return ref.get()
+    except Exception as e:
+        print(f"[ERROR] Failed to get device status: {e}")
+    return None
+
+
+def get_reading_count(device_id):
+    """
+    Get the number of stored readings for a device.
+    
+    Uses the maintained reading_count field, falling back to a shallow
+    read of the reading keys for devices written before it existed.
+    
+    Args:
+        device_id: Unique device identifier
+    
+    Returns:
+        int: Number of readings
+    """
+    try:
+        ref = get_database_reference(f"/devices/{device_id}")
+        if ref:
+            count = ref.child("reading_count").get()
+            if count is None:
+                readings = ref.child("readings").get(shallow=True)
+                count = len(readings) if readings else 0
+            return count
     except Exception as e:
-        print(f"[ERROR] Failed to update device status: {e}")
-    return False
+        print(f"[ERROR] Failed to get reading count: {e}")
+    return 0
 
 
-def get_device_data(device_id, limit=10):
+def get_device_data(device_id, limit=10, fields=None):
     """
     Get recent device readings from Firebase.
     
     Args:
         device_id: Unique device identifier
         limit: Maximum number of readings to return
+        fields: Optional list of field names to keep in each reading
     
     Returns:
         list: List of reading dictionaries
@@ -172,15 +749,33 @@ def get_device_data(device_id, limit=10):
             # Get last N readings
             data = ref.order_by_key().limit_to_last(limit).get()
             if data:
+                if fields:
+                    return [
+                        {f: reading[f] for f in fields if f in reading}
+                        for reading in data.values()
+                    ]
                 return list(data.values())
     except Exception as e:
         print(f"[ERROR] Failed to get device data: {e}")
     return []
 
 
+_alerts_cache = TTLCache(maxsize=4, ttl=ALERTS_CACHE_TTL)
+_alerts_cache_lock = threading.Lock()
+
+
+@cached(_alerts_cache, lock=_alerts_cache_lock)
 def get_alerts(limit=20):
     """
-    Get recent alerts from Firebase.
+    Get recent alerts from Firebase, newest first.
+    
+    Results are memoized per limit for ALERTS_CACHE_TTL seconds, so
+    concurrent requests share one read. The returned list is shared
+    and must not be modified.
+    
+    Alerts are ordered server-side by the indexed integer "ts_ms"
+    child (see database.rules.json). Older alerts without it sort
+    first, by push key, so the order stays chronological.
     
     Args:
         limit: Maximum number of alerts to return
@@ -191,10 +786,10 @@ def get_alerts(limit=20):
     try:
         ref = get_database_reference("/alerts")
         if ref:
-            data = ref.order_by_key().limit_to_last(limit).get()
+            data = ref.order_by_child("ts_ms").limit_to_last(limit).get()
             if data:
                 alerts = []
-                for key, value in data.items():
+                for key, value in reversed(list(data.items())):
                     value['id'] = key
                     alerts.append(value)
                 return alerts
@@ -203,6 +798,14 @@ def get_alerts(limit=20):
     return []
 
 
+def clear_alerts_cache():
+    """
+    Drop memoized get_alerts() results after an alert changes.
+    """
+    with _alerts_cache_lock:
+        _alerts_cache.clear()
+
+
 # ============== INITIALIZATION CHECK ==============
 if __name__ == "__main__":
     # Test Firebase connection
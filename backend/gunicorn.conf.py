@@ -0,0 +1,49 @@
+"""
+============================================================
+Gunicorn Configuration
+Lightweight IoT Anomaly Detection System
+============================================================
+
+Production server settings for the Flask backend. gevent workers
+let many dashboard requests overlap their Firebase network waits
+inside a single process, and independent reads within one request
+already run concurrently on the executor in app.py.
+
+Flask's async views are not used: Flask runs each one in its own
+event loop on a worker thread, so they add no concurrency over this
+setup, and wrapping the app with WsgiToAsgi under uvicorn would run
+every request through a thread pool instead of greenlets.
+
+Usage (from the backend directory):
+    gunicorn -c gunicorn.conf.py app:app
+"""
+
+import os
+
+# ============== SERVER ==============
+bind = f"{os.getenv('HOST', '0.0.0.0')}:{os.getenv('PORT', 5000)}"
+
+# Each worker starts its own MQTT client with the same client ID, and the
+# broker only keeps one session per ID. Keep a single worker and scale
+# with gevent connections instead.
+workers = int(os.getenv("WEB_CONCURRENCY", 1))
+worker_class = "gevent"
+worker_connections = int(os.getenv("WORKER_CONNECTIONS", 1000))
+
+
+# ============== HOOKS ==============
+def post_worker_init(worker):
+    """
+    Initialize Firebase and MQTT inside the worker process, after
+    gevent has patched the standard library.
+    """
+    from app import init_components
+    init_components()
+
+
+def worker_exit(server, worker):
+    """
+    Close the Firebase realtime listeners so the worker can exit.
+    """
+    from firebase_config import stop_cache_listeners
+    stop_cache_listeners()
@@ -10,19 +10,35 @@ and stores results in Firebase.
 """
 
 import paho.mqtt.client as mqtt
-import json
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+import logging
+import orjson
 import numpy as np
 import joblib
 import os
-from datetime import datetime
-from threading import Thread
+import re
+import signal
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict, is_dataclass
+from datetime import datetime, timezone
+from queue import Queue, Empty, Full
+from threading import Thread, Lock, Event, local
+
+# Optional compiled inference backend (see load_ml_model)
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
 
 # Import Firebase operations
 from firebase_config import (
     initialize_firebase,
-    save_device_data,
-    save_alert,
-    update_device_status
+    prepare_denormalized_data,
+    utc_timestamp,
+    write_batch
 )
 
 # ============== CONFIGURATION ==============
@@ -35,31 +51,304 @@ MQTT_TOPICS = [
     ("iot-cybot/gas/test", 0),   # Gas sensor
 ]
 MQTT_CLIENT_ID = "iot_backend_server_cybot"
+# MQTT v5 session: kept by the broker for this long after a disconnect,
+# so reconnects resume it instead of starting over
+MQTT_SESSION_EXPIRY = int(os.getenv("MQTT_SESSION_EXPIRY", 300))  # seconds
+# Topic format: iot-cybot/{sensor_type}/{device_name}
+TOPIC_PATTERN = re.compile(r"^iot-cybot/([^/]+)/([^/]+)$")
 
 # Model paths
 MODEL_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "ml", "iot_model.pkl")
 SCALER_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "ml", "scaler.pkl")
+ONNX_MODEL_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "ml", "iot_model.onnx")
+
+# Firebase write batching: messages only enqueue writes, and a writer
+# thread sends up to WRITE_BATCH_MAX of them per multi-path update
+WRITE_QUEUE_SIZE = int(os.getenv("WRITE_QUEUE_SIZE", 10000))
+WRITE_BATCH_MAX = int(os.getenv("WRITE_BATCH_MAX", 250))
+WRITE_BATCH_WAIT = float(os.getenv("WRITE_BATCH_WAIT", 0.05))  # seconds
+# Writer threads, each with its own queue, so several batch updates can
+# be in flight at once. Devices are pinned to one writer, which keeps
+# each device's writes in order.
+WRITER_THREADS = max(1, int(os.getenv("WRITER_THREADS", 2)))
+
+# Anomaly inference micro-batching: temperature/humidity/gas readings
+# are scored together every INFERENCE_INTERVAL seconds. Set it to 0 to
+# score each reading as it arrives (low-traffic deployments).
+INFERENCE_INTERVAL = float(os.getenv("INFERENCE_INTERVAL", 0.1))  # seconds
+
+# Idle PIR readings (no motion) that repeat the device's last state are
+# only written every PIR_KEEPALIVE seconds; motion is always written
+PIR_KEEPALIVE = float(os.getenv("PIR_KEEPALIVE", 30))  # seconds
+
+# Message handling: paho calls on_message on its network thread, which
+# only parses the topic and hands the message to one of MESSAGE_WORKERS
+# single-thread workers, picked by device so each device's messages are
+# handled one at a time and in arrival order
+MESSAGE_WORKERS = int(os.getenv("MESSAGE_WORKERS", 8))
+
+# Per-message logging. Routine messages are DEBUG, alerts are INFO and
+# failures are ERROR, so normal traffic costs nothing at the default
+# level (set with LOG_LEVEL).
+log = logging.getLogger("mqtt")
+
+# Recent INFO+ messages (alerts, errors) kept in memory for /api/status
+EVENT_BUFFER_SIZE = int(os.getenv("EVENT_BUFFER_SIZE", 1000))
+STATUS_EVENTS = 50    # Most recent events included in get_mqtt_status()
 
 # ============== GLOBAL VARIABLES ==============
+initialized = False   # Set once initialize() has succeeded
 mqtt_client = None
 model = None
+onnx_session = None   # Used instead of model when the ONNX export is available
+onnx_input = None
+onnx_scores = None
 scaler = None
+scaler_mean = None    # scaler.mean_, applied directly as (x - mean) * inv_scale
+scaler_inv_scale = None  # 1 / scaler.scale_ (multiplying is cheaper than dividing)
+scaler_terms = None   # (mean0, mean1, mean2, inv_scale0, inv_scale1, inv_scale2) as floats
+sample_buffers = local()  # Per-thread (1, 3) float32 input row for detect_anomaly
 is_connected = False
+message_workers = []  # One single-thread executor per device shard
+pir_state = {}        # device_id -> (motion_detected, monotonic time of last write)
+topic_cache = {}      # topic -> (sensor_type, device_id); topics are finite
+write_queues = [Queue(maxsize=WRITE_QUEUE_SIZE) for _ in range(WRITER_THREADS)]
+writer_threads = []
+inference_buffer = []
+inference_lock = Lock()
+inference_thread = None
+inference_stop = Event()
+
+
+# ============== RECENT EVENTS ==============
+recent_events = deque(maxlen=EVENT_BUFFER_SIZE)  # (unix time, message)
+
+
+class EventBufferHandler(logging.Handler):
+    """
+    Logging handler that keeps recent messages in recent_events.
+    """
+    def emit(self, record):
+        recent_events.append((record.created, record.getMessage()))
+
+
+log.addHandler(EventBufferHandler(level=logging.INFO))
+
+
+def get_recent_events(limit=STATUS_EVENTS):
+    """
+    Get the most recent buffered events, oldest first.
+    
+    Args:
+        limit: Maximum number of events to return
+    
+    Returns:
+        list: [{"time": ISO timestamp, "message": str}, ...]
+    """
+    events = list(recent_events)[-limit:]
+    return [
+        {
+            "time": datetime.fromtimestamp(created, timezone.utc).isoformat(timespec="milliseconds"),
+            "message": message
+        }
+        for created, message in events
+    ]
+
+
+def dump_recent_events(signum=None, frame=None):
+    """
+    Print the whole event buffer (signal handler for EVENT_DUMP_SIGNAL).
+    """
+    print(f"\n[EVENTS] Last {len(recent_events)} events:")
+    for event in get_recent_events(limit=len(recent_events)):
+        print(f"   {event['time']}  {event['message']}")
+
+
+def install_event_dump_signal():
+    """
+    Dump the event buffer on SIGUSR2 (`kill -USR2 <pid>`).
+    
+    SIGUSR1 is not used because gunicorn workers already handle it
+    (reopen log files). Signals can only be installed from the main
+    thread and don't exist on Windows; both cases are skipped.
+    """
+    if not hasattr(signal, "SIGUSR2"):
+        return
+    try:
+        signal.signal(signal.SIGUSR2, dump_recent_events)
+    except ValueError:
+        pass
+
+
+# ============== READING RECORDS ==============
+# Readings are queued as slotted records and only turned into dicts on
+# the writer thread, just before they are sent to Firebase.
+# (__slots__ is declared by hand; dataclass(slots=True) needs 3.10)
+@dataclass
+class PIRReading:
+    __slots__ = ("sensor_type", "pir_motion", "motion_detected", "timestamp", "is_anomaly")
+    sensor_type: str
+    pir_motion: int
+    motion_detected: bool
+    timestamp: str
+    is_anomaly: bool
+
+
+@dataclass
+class GasReading:
+    __slots__ = ("sensor_type", "gas_value", "gas_level", "is_high", "timestamp", "is_anomaly")
+    sensor_type: str
+    gas_value: float
+    gas_level: float
+    is_high: bool
+    timestamp: str
+    is_anomaly: bool
+
+
+@dataclass
+class THGReading:
+    __slots__ = ("sensor_type", "temperature", "humidity", "gas_level", "location",
+                 "rssi", "uptime", "timestamp", "is_anomaly", "anomaly_score")
+    sensor_type: str
+    temperature: float
+    humidity: float
+    gas_level: float
+    location: str
+    rssi: int
+    uptime: int
+    timestamp: str
+    is_anomaly: bool
+    anomaly_score: float  # None when decided by the threshold rules
+
+
+# ============== BATCHED FIREBASE WRITES ==============
+def enqueue_write(kind, device_id, data):
+    """
+    Queue a write for the writer thread (see firebase_config.write_batch).
+    
+    Args:
+        kind: "reading", "status" or "alert"
+        device_id: Unique device identifier
+        data: Dictionary or reading record to write
+    """
+    write_queue = write_queues[hash(device_id) % WRITER_THREADS]
+    try:
+        write_queue.put((kind, device_id, data), timeout=1)
+    except Full:
+        log.error("[ERROR] Write queue full, dropping %s for %s", kind, device_id)
+
+
+def writer_loop(write_queue):
+    """
+    Drain a write queue in batches until a None sentinel is received.
+    
+    Waits for the first item, then collects more for up to
+    WRITE_BATCH_WAIT seconds or WRITE_BATCH_MAX items, and writes
+    them in one round trip.
+    """
+    running = True
+    while running:
+        batch = [write_queue.get()]
+        deadline = time.monotonic() + WRITE_BATCH_WAIT
+        
+        while len(batch) < WRITE_BATCH_MAX:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(write_queue.get(timeout=timeout))
+            except Empty:
+                break
+        
+        if None in batch:
+            running = False
+            batch = [item for item in batch if item is not None]
+        
+        # Convert reading records to dicts for the Firebase client
+        batch = [
+            (kind, device_id, asdict(data) if is_dataclass(data) else data)
+            for kind, device_id, data in batch
+        ]
+        
+        if batch and write_batch(batch) is None:
+            log.error("[ERROR] Dropped batch of %d writes", len(batch))
+
+
+def start_writer():
+    """
+    Start the background writer threads (once).
+    """
+    if not writer_threads:
+        for i, write_queue in enumerate(write_queues):
+            thread = Thread(target=writer_loop, args=(write_queue,),
+                            name=f"firebase-writer-{i}", daemon=True)
+            thread.start()
+            writer_threads.append(thread)
+        print(f"[FIREBASE] Batched writer started ({WRITER_THREADS} threads)")
+
+
+def stop_writer():
+    """
+    Flush pending writes and stop the writer threads.
+    """
+    if not writer_threads:
+        return
+    
+    for write_queue in write_queues:
+        write_queue.put(None)
+    for thread in writer_threads:
+        thread.join(timeout=10)
+    writer_threads.clear()
 
 
 # ============== LOAD ML MODEL ==============
 def load_ml_model():
     """
     Load the trained Isolation Forest model and scaler.
+    
+    If ml/iot_model.onnx exists and onnxruntime is installed, the
+    forest is scored with ONNX Runtime (compiled tree traversal)
+    instead of scikit-learn, and the pickled forest is not loaded.
+    That is the preferred deployment: ONNX Runtime reads the compact
+    graph directly rather than unpickling every tree.
     """
-    global model, scaler
+    global model, scaler, scaler_mean, scaler_inv_scale, scaler_terms
+    global onnx_session, onnx_input, onnx_scores
+    
+    # Only one copy of the forest per process
+    if model_ready():
+        print("[ML] Model already loaded")
+        return True
     
     try:
         if os.path.exists(MODEL_PATH) and os.path.exists(SCALER_PATH):
-            model = joblib.load(MODEL_PATH)
             scaler = joblib.load(SCALER_PATH)
-            print(f"[ML] Model loaded from: {MODEL_PATH}")
+            
+            # Standard scaling is just (x - mean) / scale; applying it
+            # directly skips sklearn's per-call input validation.
+            # Features are float32 end to end: the forest and the ONNX
+            # graph both compare in float32, so float64 would only be
+            # converted again on every call.
+            scaler_mean = scaler.mean_.astype(np.float32)
+            inv_scale = 1.0 / scaler.scale_
+            scaler_inv_scale = inv_scale.astype(np.float32)
+            scaler_terms = tuple(scaler.mean_.tolist() + inv_scale.tolist())
             print(f"[ML] Scaler loaded from: {SCALER_PATH}")
+            
+            if onnxruntime is not None and os.path.exists(ONNX_MODEL_PATH):
+                onnx_session = onnxruntime.InferenceSession(
+                    ONNX_MODEL_PATH, providers=["CPUExecutionProvider"]
+                )
+                onnx_input = onnx_session.get_inputs()[0].name
+                outputs = [o.name for o in onnx_session.get_outputs()]
+                onnx_scores = "scores" if "scores" in outputs else outputs[-1]
+                print(f"[ML] ONNX model loaded from: {ONNX_MODEL_PATH}")
+            else:
+                # The whole forest is unpickled into memory (sklearn copies
+                # each tree's arrays into its own buffers, so mmap_mode
+                # would not help); the ONNX path above avoids this
+                model = joblib.load(MODEL_PATH)
+                print(f"[ML] Model loaded from: {MODEL_PATH}")
             return True
         else:
             print(f"[WARNING] Model files not found!")
@@ -70,7 +359,96 @@ def load_ml_model():
         return False
 
 
+def model_ready():
+    """
+    Check whether a model (ONNX or scikit-learn) and scaler are loaded.
+    """
+    return (model is not None or onnx_session is not None) and scaler is not None
+
+
+def decision_scores(X_scaled):
+    """
+    Compute IsolationForest decision_function scores for scaled rows.
+    
+    Args:
+        X_scaled: Scaled features, shape (n, 3)
+    
+    Returns:
+        ndarray: Scores of shape (n,); negative scores are anomalies
+    """
+    if onnx_session is not None:
+        scores = onnx_session.run(
+            [onnx_scores], {onnx_input: X_scaled.astype(np.float32, copy=False)}
+        )[0]
+        return scores.ravel()
+    return model.decision_function(X_scaled)
+
+
 # ============== ANOMALY DETECTION ==============
+def rule_violations(temperature, humidity, gas_level):
+    """
+    Check a reading against the simple threshold rules.
+    Missing (None) values are not checked.
+    
+    Returns:
+        list: Human-readable reasons (empty if no rule fires)
+    """
+    reasons = []
+    if temperature is not None and (temperature > 40 or temperature < 10):
+        reasons.append(f"Abnormal temperature: {temperature}°C")
+    if humidity is not None and (humidity > 80 or humidity < 20):
+        reasons.append(f"Abnormal humidity: {humidity}%")
+    if gas_level is not None and gas_level > 500:
+        reasons.append(f"High gas level detected: {gas_level}")
+    return reasons
+
+
+def anomaly_reasons(temperature, humidity, gas_level):
+    """
+    Explain an anomalous reading with simple threshold rules.
+    
+    Returns:
+        list: Human-readable reasons (never empty)
+    """
+    reasons = rule_violations(temperature, humidity, gas_level)
+    
+    # If no specific reason, use general
+    if not reasons:
+        reasons.append("Unusual sensor pattern detected")
+    return reasons
+
+
+def detect_anomalies(features):
+    """
+    Run anomaly detection on a batch of readings in one model call.
+    
+    Args:
+        features: Sequence of (temperature, humidity, gas_level) rows
+    
+    Returns:
+        tuple: (is_anomaly, anomaly_scores) arrays of shape (n,)
+    """
+    n = len(features)
+    if not model_ready():
+        log.debug("[WARNING] ML model not loaded, skipping anomaly detection")
+        return np.zeros(n, dtype=bool), np.zeros(n)
+    
+    try:
+        X_scaled = np.asarray(features, dtype=np.float32)
+        X_scaled -= scaler_mean
+        X_scaled *= scaler_inv_scale
+        
+        # Lower score = more anomalous; negative scores are anomalies
+        # (this is exactly how IsolationForest.predict labels them)
+        anomaly_scores = decision_scores(X_scaled)
+        
+        return anomaly_scores < 0, anomaly_scores
+        
+    except Exception as e:
+        log.error("[ERROR] Batch anomaly detection failed: %s", e)
+        return np.zeros(n, dtype=bool), np.zeros(n)
+
+
 def detect_anomaly(temperature, humidity, gas_level):
     """
     Run anomaly detection on sensor data.
@@ -83,46 +461,40 @@ def detect_anomaly(temperature, humidity, gas_level):
     Returns:
         tuple: (is_anomaly, anomaly_score, reasons)
     """
-    if model is None or scaler is None:
-        print("[WARNING] ML model not loaded, skipping anomaly detection")
+    if not model_ready():
+        log.debug("[WARNING] ML model not loaded, skipping anomaly detection")
         return False, 0, []
     
     try:
-        # Prepare input
-        X = np.array([[temperature, humidity, gas_level]])
-        X_scaled = scaler.transform(X)
-        
-        # Get prediction (-1 = anomaly, 1 = normal)
-        prediction = model.predict(X_scaled)[0]
+        # Scale into this thread's preallocated input row
+        X_scaled = getattr(sample_buffers, "row", None)
+        if X_scaled is None:
+            X_scaled = sample_buffers.row = np.empty((1, 3), dtype=np.float32)
+        # Three scalars: plain float math beats numpy ufunc dispatch here
+        mean0, mean1, mean2, inv0, inv1, inv2 = scaler_terms
+        X_scaled[0, 0] = (temperature - mean0) * inv0
+        X_scaled[0, 1] = (humidity - mean1) * inv1
+        X_scaled[0, 2] = (gas_level - mean2) * inv2
         
         # Get anomaly score (lower = more anomalous)
-        anomaly_score = model.decision_function(X_scaled)[0]
+        anomaly_score = decision_scores(X_scaled)[0]
         
-        is_anomaly = prediction == -1
+        # Negative scores are anomalies, exactly as IsolationForest.predict
+        # labels them, so the trees are only traversed once
+        is_anomaly = bool(anomaly_score < 0)
         
         # Determine reasons for anomaly
-        reasons = []
-        if is_anomaly:
-            if temperature > 40 or temperature < 10:
-                reasons.append(f"Abnormal temperature: {temperature}°C")
-            if humidity > 80 or humidity < 20:
-                reasons.append(f"Abnormal humidity: {humidity}%")
-            if gas_level > 500:
-                reasons.append(f"High gas level detected: {gas_level}")
-            
-            # If no specific reason, use general
-            if not reasons:
-                reasons.append("Unusual sensor pattern detected")
+        reasons = anomaly_reasons(temperature, humidity, gas_level) if is_anomaly else []
         
         return is_anomaly, float(anomaly_score), reasons
         
     except Exception as e:
-        print(f"[ERROR] Anomaly detection failed: {e}")
+        log.error("[ERROR] Anomaly detection failed: %s", e)
         return False, 0, []
 
 
 # ============== MQTT CALLBACKS ==============
-def on_connect(client, userdata, flags, rc):
+def on_connect(client, userdata, flags, rc, properties=None):
     """
     Callback when MQTT client connects to broker.
     """
@@ -141,7 +513,7 @@ def on_connect(client, userdata, flags, rc):
         print(f"[MQTT] Connection failed with code: {rc}")
 
 
-def on_disconnect(client, userdata, rc):
+def on_disconnect(client, userdata, rc, properties=None):
     """
     Callback when MQTT client disconnects.
     """
@@ -156,175 +528,289 @@ def on_disconnect(client, userdata, rc):
 def on_message(client, userdata, msg):
     """
     Callback when MQTT message is received.
-    Handles topics like: iot-cybot/pir/test, iot-cybot/gas/test, etc.
+    
+    Runs on paho's network thread, so it only timestamps the message,
+    parses the topic and hands it to the device's message worker (see
+    handle_message).
     """
+    # Sensor payloads are JSON objects; reject anything else before it
+    # is copied, queued or parsed
+    if msg.payload[:1] != b"{":
+        log.error("[ERROR] Invalid JSON payload on %s: not an object", msg.topic)
+        return
+    
+    # Timestamp once at ingress; shared by the reading, status and alert
+    timestamp = utc_timestamp()
+    
+    sensor_type, device_id = parse_topic(msg.topic)
+    
+    if not message_workers:
+        handle_message(msg.topic, sensor_type, device_id, msg.payload, timestamp)
+        return
+    
+    # Same device -> same worker, like the write queues, so an older
+    # reading can never be processed after a newer one
+    worker = message_workers[hash(device_id) % len(message_workers)]
+    
+    # Copy the payload; paho may reuse its buffer for the next message
     try:
-        # Parse topic to get sensor type and device ID
-        # Topic format: iot-cybot/{sensor_type}/{device_name}
-        topic_parts = msg.topic.split("/")
-        
+        worker.submit(handle_message, msg.topic, sensor_type, device_id,
+                      bytes(msg.payload), timestamp)
+    except RuntimeError:
+        # Worker already shut down (client stopping)
+        pass
+
+
+def parse_topic(topic):
+    """
+    Get the sensor type and device ID for a topic (cached per topic).
+    
+    Args:
+        topic: e.g. "iot-cybot/pir/test"
+    
+    Returns:
+        (sensor_type, device_id), e.g. ("pir", "pir_test")
+    """
+    parsed = topic_cache.get(topic)
+    if parsed is not None:
+        return parsed
+    
+    match = TOPIC_PATTERN.match(topic)
+    if match:
+        sensor_type, device_name = match.group(1, 2)
+    else:
+        # Non-standard topics: iot-cybot/{sensor_type}[/{device_name}/...]
+        topic_parts = topic.split("/")
         if len(topic_parts) >= 3:
-            sensor_type = topic_parts[1]  # e.g., "pir", "gas"
-            device_name = topic_parts[2]  # e.g., "test"
-            # Create unique device_id by combining sensor_type + device_name
-            device_id = f"{sensor_type}_{device_name}"  # e.g., "pir_test", "gas_test"
+            sensor_type = topic_parts[1]
+            device_name = topic_parts[2]
         elif len(topic_parts) >= 2:
             sensor_type = topic_parts[1]
             device_name = "default"
-            device_id = f"{sensor_type}_{device_name}"
         else:
             sensor_type = "unknown"
-            device_name = "unknown"
-            device_id = "unknown_device"
-        
-        # Decode JSON payload
-        payload = json.loads(msg.payload.decode('utf-8'))
+            device_name = None
+    
+    # Unique device_id combines sensor_type + device_name, e.g. "pir_test"
+    device_id = f"{sensor_type}_{device_name}" if device_name is not None else "unknown_device"
+    parsed = (sensor_type, device_id)
+    topic_cache[topic] = parsed
+    return parsed
+
+
+def handle_message(topic, sensor_type, device_id, payload_bytes, timestamp):
+    """
+    Decode and process one MQTT message on the device's message worker.
+    Handles topics like: iot-cybot/pir/test, iot-cybot/gas/test, etc.
+    
+    Args:
+        topic: MQTT topic the message was received on
+        sensor_type: Sensor type parsed from the topic
+        device_id: Device ID parsed from the topic
+        payload_bytes: Raw JSON payload
+        timestamp: UTC ingress timestamp from on_message
+    """
+    try:
+        # Decode JSON payload (orjson parses the bytes directly)
+        payload = orjson.loads(payload_bytes)
         
-        print(f"\n[MQTT] Message received on topic: {msg.topic}")
-        print(f"[MQTT] Sensor Type: {sensor_type}, Device ID: {device_id}")
-        print(f"[DATA] {json.dumps(payload, indent=2)}")
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("[MQTT] Message on %s (sensor=%s, device=%s): %s",
+                      topic, sensor_type, device_id, payload)
         
         # Process the sensor data
-        process_sensor_data(device_id, payload, sensor_type)
+        process_sensor_data(device_id, payload, sensor_type, timestamp)
         
-    except json.JSONDecodeError as e:
-        print(f"[ERROR] Invalid JSON payload: {e}")
+    except orjson.JSONDecodeError as e:
+        log.error("[ERROR] Invalid JSON payload: %s", e)
     except Exception as e:
-        print(f"[ERROR] Message processing failed: {e}")
+        log.error("[ERROR] Message processing failed: %s", e)
 
 
 # ============== DATA PROCESSING ==============
-def process_sensor_data(device_id, data, sensor_type="sensors"):
+def process_sensor_data(device_id, data, sensor_type="sensors", timestamp=None):
     """
     Process incoming sensor data:
     1. Validate data
     2. Run anomaly detection (for temperature/humidity/gas sensors)
-    3. Save to Firebase
-    4. Generate alerts if needed
+    3. Queue the reading and status writes for Firebase
+    4. Queue alerts if needed
     
     Supports:
     - PIR motion sensors (pir_motion field)
     - Temperature/Humidity/Gas sensors
+    
+    Args:
+        device_id: Unique device identifier
+        data: Decoded JSON payload
+        sensor_type: Sensor type from the topic (e.g., "pir", "gas")
+        timestamp: Ingress time from on_message (defaults to now)
     """
-    timestamp = datetime.now().isoformat()
+    if timestamp is None:
+        timestamp = utc_timestamp()
     
-    # Handle PIR Motion Sensor
-    if sensor_type == "pir" or "pir_motion" in data:
-        pir_value = data.get('pir_motion', 0)
-        motion_detected = pir_value == 0  # Based on your ESP code: 0 = motion detected
-        
-        reading_data = {
-            "sensor_type": "pir",
-            "pir_motion": pir_value,
-            "motion_detected": motion_detected,
-            "timestamp": timestamp,
-            "is_anomaly": motion_detected  # Motion = potential threat
-        }
-        
-        # Save to Firebase
-        save_device_data(device_id, reading_data)
-        
-        # Update device status
-        status = "threat" if motion_detected else "normal"
-        update_device_status(device_id, {
-            "state": status,
-            "last_seen": timestamp,
-            "sensor_type": "pir",
-            "motion_detected": motion_detected
-        })
-        
-        # Create alert if motion detected
-        if motion_detected:
-            alert_data = {
-                "device_id": device_id,
-                "timestamp": timestamp,
-                "type": "motion",
-                "severity": "high",
-                "pir_motion": pir_value,
-                "message": "🚨 Motion Detected!",
-                "acknowledged": False
-            }
-            save_alert(device_id, alert_data)
-            print(f"[ALERT] ⚠️  Motion detected on {device_id}!")
-        else:
-            print(f"[OK] Device {device_id}: No motion")
-        
+    handler = SENSOR_HANDLERS.get(sensor_type, handle_thg_reading)
+    handler(device_id, data, sensor_type, timestamp)
+
+
+def handle_pir_reading(device_id, data, sensor_type, timestamp):
+    """
+    Handle a PIR motion sensor reading (pir_motion field).
+    """
+    pir_value = data.get('pir_motion', 0)
+    motion_detected = pir_value == 0  # Based on your ESP code: 0 = motion detected
+    
+    # Skip idle pings that don't change anything until the keepalive is due
+    # (a device's messages all run on its own worker, so this
+    # check-then-set doesn't race)
+    now = time.monotonic()
+    previous = pir_state.get(device_id)
+    if (not motion_detected and previous is not None and not previous[0]
+            and now - previous[1] < PIR_KEEPALIVE):
+        log.debug("[OK] Device %s: No motion (unchanged)", device_id)
         return
+    pir_state[device_id] = (motion_detected, now)
     
-    # Handle Gas Sensor
-    if sensor_type == "gas" or "gas_value" in data:
-        gas_value = data.get('gas_value', data.get('gas_level', 0))
-        gas_threshold = 500  # Threshold for high gas level
-        is_high_gas = gas_value > gas_threshold
-        
-        reading_data = {
-            "sensor_type": "gas",
-            "gas_value": gas_value,
-            "gas_level": gas_value,
-            "is_high": is_high_gas,
+    # Motion = potential threat
+    reading = PIRReading("pir", pir_value, motion_detected, timestamp, motion_detected)
+    
+    # Save to Firebase
+    enqueue_write("reading", device_id, reading)
+    
+    # Update device status
+    status = "threat" if motion_detected else "normal"
+    enqueue_write("status", device_id, {
+        "state": status,
+        "last_seen": timestamp,
+        "sensor_type": "pir",
+        "motion_detected": motion_detected
+    })
+    
+    # Create alert if motion detected
+    if motion_detected:
+        alert_data = {
+            "device_id": device_id,
             "timestamp": timestamp,
-            "is_anomaly": is_high_gas
+            "type": "motion",
+            "severity": "high",
+            "pir_motion": pir_value,
+            "message": "🚨 Motion Detected!",
+            "acknowledged": False
         }
-        
-        # Save to Firebase
-        save_device_data(device_id, reading_data)
-        
-        # Update device status
-        status = "threat" if is_high_gas else "normal"
-        update_device_status(device_id, {
-            "state": status,
-            "last_seen": timestamp,
-            "sensor_type": "gas",
+        enqueue_write("alert", device_id, alert_data)
+        log.info("[ALERT] ⚠️  Motion detected on %s!", device_id)
+    else:
+        log.debug("[OK] Device %s: No motion", device_id)
+
+
+def handle_gas_reading(device_id, data, sensor_type, timestamp):
+    """
+    Handle a gas sensor reading (gas_value or gas_level field).
+    """
+    gas_value = data.get('gas_value', data.get('gas_level', 0))
+    gas_threshold = 500  # Threshold for high gas level
+    is_high_gas = gas_value > gas_threshold
+    
+    reading = GasReading("gas", gas_value, gas_value, is_high_gas, timestamp, is_high_gas)
+    
+    # Save to Firebase
+    enqueue_write("reading", device_id, reading)
+    
+    # Update device status
+    status = "threat" if is_high_gas else "normal"
+    enqueue_write("status", device_id, {
+        "state": status,
+        "last_seen": timestamp,
+        "sensor_type": "gas",
+        "gas_level": gas_value,
+        "is_high": is_high_gas
+    })
+    
+    # Create alert if high gas detected
+    if is_high_gas:
+        alert_data = {
+            "device_id": device_id,
+            "timestamp": timestamp,
+            "type": "gas",
+            "severity": "high",
             "gas_level": gas_value,
-            "is_high": is_high_gas
-        })
-        
-        # Create alert if high gas detected
-        if is_high_gas:
-            alert_data = {
-                "device_id": device_id,
-                "timestamp": timestamp,
-                "type": "gas",
-                "severity": "high",
-                "gas_level": gas_value,
-                "message": f"🔥 High Gas Level Detected: {gas_value}",
-                "acknowledged": False
-            }
-            save_alert(device_id, alert_data)
-            print(f"[ALERT] ⚠️  High gas level on {device_id}: {gas_value}")
-        else:
-            print(f"[OK] Device {device_id}: Gas level normal ({gas_value})")
-        
+            "message": f"🔥 High Gas Level Detected: {gas_value}",
+            "acknowledged": False
+        }
+        enqueue_write("alert", device_id, alert_data)
+        log.info("[ALERT] ⚠️  High gas level on %s: %s", device_id, gas_value)
+    else:
+        log.debug("[OK] Device %s: Gas level normal (%s)", device_id, gas_value)
+
+
+def handle_thg_reading(device_id, data, sensor_type, timestamp):
+    """
+    Handle a temperature/humidity/gas reading: check the threshold
+    rules, score it with the model (batched or inline) if they don't
+    decide it, and queue its writes.
+    
+    Also the default for unknown sensor types, so PIR and gas payloads
+    published on other topics are still recognized by their fields.
+    """
+    if "pir_motion" in data:
+        return handle_pir_reading(device_id, data, sensor_type, timestamp)
+    if "gas_value" in data:
+        return handle_gas_reading(device_id, data, sensor_type, timestamp)
+    
+    temperature = data.get('temperature')
+    humidity = data.get('humidity')
+    gas_level = data.get('gas_level')
+    
+    # The model is only needed when the rules are silent and all three
+    # features are present; a missing value would be scored as 0
+    reasons = rule_violations(temperature, humidity, gas_level)
+    rule_decided = (bool(reasons) or temperature is None or humidity is None
+                    or gas_level is None)
+    
+    if INFERENCE_INTERVAL > 0:
+        # Scored with other readings by the inference thread. Readings
+        # decided by the rules go through the buffer too (with their
+        # reasons), so a device's writes stay in arrival order.
+        with inference_lock:
+            inference_buffer.append((device_id, sensor_type, data, timestamp,
+                                     reasons if rule_decided else None))
         return
     
-    # Handle Temperature/Humidity/Gas Sensors
-    temperature = data.get('temperature', 0)
-    humidity = data.get('humidity', 0)
-    gas_level = data.get('gas_level', 0)
+    if rule_decided:
+        save_thg_reading(device_id, sensor_type, data, timestamp,
+                         bool(reasons), None, reasons)
+        return
     
     # Run anomaly detection
     is_anomaly, score, reasons = detect_anomaly(temperature, humidity, gas_level)
+    save_thg_reading(device_id, sensor_type, data, timestamp, is_anomaly, score, reasons)
+
+
+def save_thg_reading(device_id, sensor_type, data, timestamp, is_anomaly, score, reasons):
+    """
+    Queue the Firebase writes (and alert) for a scored
+    temperature/humidity/gas reading.
+    
+    score is None when the reading was decided by the threshold rules
+    without running the model.
+    """
+    temperature = data.get('temperature', 0)
+    humidity = data.get('humidity', 0)
+    gas_level = data.get('gas_level', 0)
     
     # Prepare data for Firebase
-    reading_data = {
-        "sensor_type": sensor_type,
-        "temperature": temperature,
-        "humidity": humidity,
-        "gas_level": gas_level,
-        "location": data.get('location', 'Unknown'),
-        "rssi": data.get('rssi', 0),
-        "uptime": data.get('uptime', 0),
-        "timestamp": timestamp,
-        "is_anomaly": is_anomaly,
-        "anomaly_score": score
-    }
+    reading = THGReading(
+        sensor_type, temperature, humidity, gas_level,
+        data.get('location', 'Unknown'), data.get('rssi', 0), data.get('uptime', 0),
+        timestamp, is_anomaly, score
+    )
     
     # Save reading to Firebase
-    save_device_data(device_id, reading_data)
+    enqueue_write("reading", device_id, reading)
     
     # Update device status
     status = "threat" if is_anomaly else "normal"
-    update_device_status(device_id, {
+    enqueue_write("status", device_id, {
         "state": status,
         "last_seen": timestamp,
         "sensor_type": sensor_type,
@@ -339,7 +825,7 @@ def process_sensor_data(device_id, data, sensor_type="sensors"):
             "device_id": device_id,
             "timestamp": timestamp,
             "type": "anomaly",
-            "severity": "high" if score < -0.5 else "medium",
+            "severity": "high" if score is None or score < -0.5 else "medium",
             "temperature": temperature,
             "humidity": humidity,
             "gas_level": gas_level,
@@ -349,11 +835,100 @@ def process_sensor_data(device_id, data, sensor_type="sensors"):
             "acknowledged": False
         }
         
-        save_alert(device_id, alert_data)
-        print(f"[ALERT] ⚠️  Anomaly detected on {device_id}!")
-        print(f"[ALERT] Reasons: {', '.join(reasons)}")
+        enqueue_write("alert", device_id, alert_data)
+        log.info("[ALERT] ⚠️  Anomaly detected on %s! Reasons: %s",
+                 device_id, ", ".join(reasons))
     else:
-        print(f"[OK] Device {device_id} readings are normal")
+        log.debug("[OK] Device %s readings are normal", device_id)
+
+
+# Sensor type (from the topic) -> handler; anything else is treated as
+# a temperature/humidity/gas reading
+SENSOR_HANDLERS = {
+    "pir": handle_pir_reading,
+    "gas": handle_gas_reading,
+}
+
+
+# ============== BATCHED INFERENCE ==============
+def score_pending_readings():
+    """
+    Score all buffered temperature/humidity/gas readings with a single
+    model call and queue their writes, in arrival order.
+    
+    Buffered entries carry the rule reasons when the threshold rules
+    already decided the reading (see handle_thg_reading), or None when
+    the model has to score it.
+    """
+    global inference_buffer
+    
+    with inference_lock:
+        pending, inference_buffer = inference_buffer, []
+    
+    if not pending:
+        return
+    
+    # Only readings with all three features are left to the model
+    features = [
+        (data['temperature'], data['humidity'], data['gas_level'])
+        for _, _, data, _, rule_reasons in pending
+        if rule_reasons is None
+    ]
+    if features:
+        is_anomaly, scores = detect_anomalies(features)
+    
+    row = 0
+    for device_id, sensor_type, data, timestamp, rule_reasons in pending:
+        if rule_reasons is not None:
+            save_thg_reading(device_id, sensor_type, data, timestamp,
+                             bool(rule_reasons), None, rule_reasons)
+            continue
+        
+        anomalous = bool(is_anomaly[row])
+        # Reasons are only built for the (rare) anomalous rows
+        reasons = anomaly_reasons(*features[row]) if anomalous else []
+        save_thg_reading(device_id, sensor_type, data, timestamp,
+                         anomalous, float(scores[row]), reasons)
+        row += 1
+
+
+def inference_loop():
+    """
+    Score buffered readings every INFERENCE_INTERVAL seconds until
+    inference_stop is set, then score what is left.
+    """
+    while not inference_stop.wait(INFERENCE_INTERVAL):
+        try:
+            score_pending_readings()
+        except Exception as e:
+            log.error("[ERROR] Batch inference failed: %s", e)
+    score_pending_readings()
+
+
+def start_inference():
+    """
+    Start the batched inference thread (once), unless per-message
+    inference is configured.
+    """
+    global inference_thread
+    
+    if INFERENCE_INTERVAL > 0 and inference_thread is None:
+        inference_stop.clear()
+        inference_thread = Thread(target=inference_loop, name="inference", daemon=True)
+        inference_thread.start()
+        print(f"[ML] Batched inference every {INFERENCE_INTERVAL}s")
+
+
+def stop_inference():
+    """
+    Score remaining buffered readings and stop the inference thread.
+    """
+    global inference_thread
+    
+    if inference_thread is not None:
+        inference_stop.set()
+        inference_thread.join(timeout=10)
+        inference_thread = None
 
 
 # ============== MQTT CLIENT SETUP ==============
@@ -363,10 +938,25 @@ def start_mqtt_client():
     """
     global mqtt_client
     
+    # A second client with the same client ID would kick the first one
+    # off the broker and duplicate every write
+    if mqtt_client is not None:
+        print("[MQTT] Client already started")
+        return True
+    
     print("\n[MQTT] Initializing MQTT client...")
     
-    # Create client
-    mqtt_client = mqtt.Client(MQTT_CLIENT_ID)
+    if not message_workers:
+        message_workers.extend(
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"mqtt-worker-{i}")
+            for i in range(MESSAGE_WORKERS)
+        )
+    
+    # Create client (MQTT v5; clean_session is replaced by clean_start)
+    mqtt_client = mqtt.Client(MQTT_CLIENT_ID, protocol=mqtt.MQTTv5)
+    
+    # Back off between automatic reconnects done by loop_start()
+    mqtt_client.reconnect_delay_set(min_delay=1, max_delay=30)
     
     # Set callbacks
     mqtt_client.on_connect = on_connect
@@ -381,7 +971,13 @@ def start_mqtt_client():
     
     try:
         # Connect to broker
-        mqtt_client.connect(MQTT_BROKER, MQTT_PORT, keepalive=60)
+        # Resume the broker-side session across reconnects
+        connect_properties = Properties(PacketTypes.CONNECT)
+        connect_properties.SessionExpiryInterval = MQTT_SESSION_EXPIRY
+        mqtt_client.connect(
+            MQTT_BROKER, MQTT_PORT, keepalive=60,
+            clean_start=False, properties=connect_properties
+        )
         
         # Start network loop in background thread
         mqtt_client.loop_start()
@@ -389,6 +985,7 @@ def start_mqtt_client():
         return True
         
     except Exception as e:
+        mqtt_client = None
         print(f"[ERROR] Failed to connect to MQTT broker: {e}")
         print(f"[INFO] Make sure MQTT broker is running at {MQTT_BROKER}:{MQTT_PORT}")
         return False
@@ -396,14 +993,26 @@ def start_mqtt_client():
 
 def stop_mqtt_client():
     """
-    Stop the MQTT client gracefully.
+    Stop the MQTT client gracefully and flush pending writes.
     """
-    global mqtt_client
+    global mqtt_client, initialized
+    
+    initialized = False
     
     if mqtt_client:
         mqtt_client.loop_stop()
         mqtt_client.disconnect()
+        mqtt_client = None
         print("[MQTT] Client stopped")
+    
+    # Finish messages already handed to the workers
+    for worker in message_workers:
+        worker.shutdown(wait=True)
+    message_workers.clear()
+    
+    # Score buffered readings, then flush writes queued so far
+    stop_inference()
+    stop_writer()
 
 
 def get_mqtt_status():
@@ -414,7 +1023,8 @@ def get_mqtt_status():
         "connected": is_connected,
         "broker": MQTT_BROKER,
         "port": MQTT_PORT,
-        "topics": [t[0] for t in MQTT_TOPICS]
+        "topics": [t[0] for t in MQTT_TOPICS],
+        "recent_events": get_recent_events()
     }
 
 
@@ -425,7 +1035,16 @@ def initialize():
     1. Firebase
     2. ML Model
     3. MQTT Client
+    
+    Safe to call more than once; after a successful run it returns
+    immediately.
     """
+    global initialized
+    
+    if initialized:
+        print("[MQTT] Handler already initialized")
+        return True
+    
     print("\n" + "="*50)
     print("   MQTT Handler Initialization")
     print("="*50)
@@ -434,10 +1053,22 @@ def initialize():
     print("\n[STEP 1] Initializing Firebase...")
     firebase_ok = initialize_firebase()
     
+    # Denormalized nodes must be complete before the writer starts
+    # incrementing counters
+    if firebase_ok:
+        prepare_denormalized_data()
+    
     # Load ML model
     print("\n[STEP 2] Loading ML model...")
     model_ok = load_ml_model()
     
+    # `kill -USR2 <pid>` prints the recent event buffer
+    install_event_dump_signal()
+    
+    # Start batched Firebase writer and inference before any messages arrive
+    start_writer()
+    start_inference()
+    
     # Start MQTT client
     print("\n[STEP 3] Starting MQTT client...")
     mqtt_ok = start_mqtt_client()
@@ -450,13 +1081,14 @@ def initialize():
     print(f"   MQTT:     {'✓ OK' if mqtt_ok else '✗ FAILED'}")
     print("="*50 + "\n")
     
-    return firebase_ok and mqtt_ok
+    initialized = firebase_ok and mqtt_ok
+    return initialized
 
 
 # ============== MAIN ==============
 if __name__ == "__main__":
     # Run standalone for testing
-    import time
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format="%(message)s")
     
     if initialize():
         print("\n[INFO] MQTT Handler running. Press Ctrl+C to stop.")